@@ -20,7 +20,9 @@ github_root  = "https://github.com/"
 
 # Define a set of dependencies that exist as separate git projects.
 # each git dependency has a desired directory where it will be cloned - along with a commit to checkout
-# The third parameter in the value field is whether to do a shallow clone. Usually, this will be True but if a commit hash is used as a branch, a full clone is needed.
+# The optional third parameter in the value field is whether to do a shallow clone (default: True). Usually, this will be True but if a commit hash is used as a branch, it must be False
+# so that a blobless clone is done and the required commit is then fetched on its own.
+# The optional fourth parameter in the value field is whether to recurse into submodules (default: False).
 git_mapping = {
     github_tools + "qt_common"                                      : ["../external/qt_common",          "v4.0.0",                                   True],
     github_tools + "update_check_api"                               : ["../external/update_check_api",   "v2.1.1",                                   True],
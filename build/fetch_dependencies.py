@@ -6,33 +6,46 @@
 ## \brief Script to fetch all external git and/or downloadable dependencies
 ##        needed to build the project.
 ##
-##   fetch_dependencies.py (--internal)
+##   fetch_dependencies.py (--internal) (--jobs N)
 ##
 ## If --internal is specified, then any additional dependencies required for internal builds will also
 ## be checked out.
 ##
+## If --jobs is specified, then up to N git repos will be cloned or updated concurrently (default: 8).
+##
 ## Each git repo will be updated to the commit specified in the "gitMapping" table.
 ##=============================================================================
 
 import os
+import stat
+import shutil
+import re
+import json
+import tempfile
 import subprocess
 import sys
-import zipfile
-import tarfile
-import platform
+import threading
+import concurrent.futures
 import argparse
 
 # Indices for fields in the git_mapping struct.
 kDestinationIndex = 0
 kCommitIndex = 1
 kShallowCloneIndex = 2
+kRecurseSubmodulesIndex = 3
+
+# Default number of git repos to process concurrently.
+kDefaultJobs = 8
+
+# Number of submodules to fetch concurrently for repos that recurse into submodules.
+kSubmoduleJobs = 8
+
+# Minimum git version needed: 'git switch' is used to check out every dependency (partial clones need an older 2.19).
+kMinGitVersion = (2, 23)
 
-# Check for the python 3.x name and import it as the 2.x name
-try:
-    import urllib.request as urllib
-# if that failed, then try the 2.x name
-except ImportError:
-    import urllib
+# Base command for git operations that talk to a remote. Protocol v2 lets the server skip advertising
+# every ref up front, which is most of the cost of talking to tag-heavy repos such as Vulkan-Headers.
+kGitRemoteCommand = ["git", "-c", "protocol.version=2"]
 
 # to allow the script to be run from anywhere - not just the cwd - store the absolute path to the script file
 script_root = os.path.dirname(os.path.realpath(__file__))
@@ -40,81 +53,306 @@ script_root = os.path.dirname(os.path.realpath(__file__))
 # also store the basename of the file
 script_name = os.path.basename(__file__)
 
+# File recording the commit each git dependency was last updated to, so unchanged repos can be skipped
+lock_file = os.path.join(script_root, ".deps.lock")
+
+# Lock used to serialize console output from the worker threads
+log_lock = threading.Lock()
+
 # Print a message to the console with appropriate pre-amble
 def log_print(message):
-    print ("\n" + script_name + ": " + message)
-    sys.stdout.flush()
+    log_print_all([message])
+
+# Print a list of messages to the console with appropriate pre-amble, flushing once at the end
+def log_print_all(messages):
+    with log_lock:
+        for message in messages:
+            print ("\n" + script_name + ": " + message)
+        sys.stdout.flush()
 
 # add script root to support import of URL and git maps
 sys.path.append(script_root)
 from dependency_map import git_mapping
 
-# Clone or update a git repo
-def update_git_dependencies(git_mapping, update):
+# Cached output of 'git --version', so that it is only queried once per process
+_GIT_VERSION = None
+
+# Run a command to completion, capturing its output. Returns the subprocess.CompletedProcess.
+# Commands that operate on an existing repo pass it with 'git -C <path>' rather than relying on the working directory.
+def _run(cmd):
+    return subprocess.run(cmd, capture_output=True, text=True)
+
+# Run a git command that is required to succeed. Returns the subprocess.CompletedProcess.
+# Raises a RuntimeError describing the failure, along with any error output, if it returns non-zero.
+def _git(cmd, description):
+    p = _run(cmd)
+    if p.returncode != 0:
+        message = "%s failed with return code: %d" % (description, p.returncode)
+        if p.stderr:
+            message = message + "\n" + p.stderr.strip()
+        raise RuntimeError(message)
+    return p
+
+# Returns the output of 'git --version'
+def get_git_version():
+    global _GIT_VERSION
+    if _GIT_VERSION is None:
+        _GIT_VERSION = _run(["git", "--version"]).stdout.strip()
+    return _GIT_VERSION
+
+# Extract the (major, minor) version from 'git --version' output. Returns None if it can't be parsed.
+def _parse_git_version(version):
+    match = re.search(r"(\d+)\.(\d+)", version)
+    if match is None:
+        return None
+    return (int(match.group(1)), int(match.group(2)))
+
+# Returns True if the string looks like a (possibly abbreviated) commit hash rather than a tag or branch name
+def _is_commit_hash(commit):
+    return re.fullmatch(r"[0-9a-f]{7,40}", commit) is not None
+
+# Resolve a ref to a full commit hash using only the local repo. Returns None if it can't be resolved.
+def _resolve_local_commit(path, ref):
+    p = _run(["git", "-C", path, "rev-parse", "--verify", "--quiet", ref + "^{commit}"])
+    if p.returncode != 0:
+        return None
+    return p.stdout.strip()
+
+# Returns True if the repo in path is already checked out at the required commit and has no local changes.
+# Branch names aren't resolved since the local branch may be behind the remote.
+def _is_up_to_date(path, reqd_commit):
+    head = _resolve_local_commit(path, "HEAD")
+    if head is None:
+        return False
+    if _is_commit_hash(reqd_commit):
+        target = _resolve_local_commit(path, reqd_commit)
+    else:
+        target = _resolve_local_commit(path, "refs/tags/" + reqd_commit)
+    if head != target:
+        return False
+    p = _run(["git", "-C", path, "status", "--porcelain", "--untracked-files=no"])
+    return p.returncode == 0 and p.stdout == ""
+
+# Fetching a tag by name only updates FETCH_HEAD, so create the tag locally so that later runs can check it
+# without going to the network. Branches are left alone since they are expected to move.
+def _record_fetched_tag(path, reqd_commit):
+    try:
+        with open(os.path.join(path, ".git", "FETCH_HEAD")) as f:
+            fetched = f.readline()
+    except OSError:
+        return
+    if ("\ttag '%s' of " % reqd_commit) in fetched:
+        _run(["git", "-C", path, "tag", "-f", reqd_commit, "FETCH_HEAD"])
+
+# Get the full path that a git dependency is cloned to
+def _get_repo_path(entry):
+    # add script directory to path
+    tmp_path = os.path.join(script_root, entry[kDestinationIndex])
+
+    # clean up path, collapsing any ../ and converting / to \ for Windows
+    return os.path.normpath(tmp_path)
+
+# Check that every git dependency has been cloned and checked out, without running git.
+# A directory holding only .git (e.g. from a clone whose checkout never happened) doesn't count.
+# Failed clones are also removed by _update_repo, so this is a second line of defence.
+def dependencies_exist():
+    return all(_is_checked_out(_get_repo_path(entry)) for entry in git_mapping.values())
+
+# Returns True if the path holds a git repo with a HEAD and a working tree containing more than .git
+def _is_checked_out(path):
+    if _read_head(path) is None:
+        return False
+    try:
+        with os.scandir(path) as entries:
+            return any(entry.name != ".git" for entry in entries)
+    except OSError:
+        return False
+
+# Read the contents of a repo's HEAD file directly, without running git. Returns None if it can't be read.
+def _read_head(path):
+    try:
+        with open(os.path.join(path, ".git", "HEAD")) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+# Load the lock file. Returns an empty dictionary if it doesn't exist or can't be parsed.
+def _load_lock():
+    try:
+        with open(lock_file) as f:
+            lock = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return lock if isinstance(lock, dict) else {}
+
+# Write the lock file, replacing any previous version atomically
+def _save_lock(lock):
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(lock_file) + ".", dir=os.path.dirname(lock_file))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(lock, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, lock_file)
+    except OSError as e:
+        log_print("Unable to write lock file %s: %s" % (lock_file, str(e)))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Returns True if the lock file shows the repo was last updated to the required commit and it hasn't moved since
+def _is_locked(lock_entry, entry):
+    if not isinstance(lock_entry, dict) or lock_entry.get("commit") != entry[kCommitIndex]:
+        return False
+    head = _read_head(_get_repo_path(entry))
+    return head is not None and head == lock_entry.get("head")
+
+# Create the lock file entry for a repo that has just been updated. Returns None if it shouldn't be locked.
+# Only commit hashes and tags are locked since a branch is expected to move.
+def _create_lock_entry(entry):
+    path = _get_repo_path(entry)
+    reqd_commit = entry[kCommitIndex]
+    head = _read_head(path)
+    if head is None:
+        return None
+    if not _is_commit_hash(reqd_commit) and _resolve_local_commit(path, "refs/tags/" + reqd_commit) is None:
+        return None
+    return {"commit": reqd_commit, "head": head}
+
+# Returns True if the repo is a shallow clone
+def _is_shallow(path):
+    return _run(["git", "-C", path, "rev-parse", "--is-shallow-repository"]).stdout.strip() == "true"
+
+# shutil.rmtree error handler that clears the read-only attribute git sets on its object files (on Windows) and retries
+def _remove_readonly(func, path, exc_info):
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+# Check out the required commit, fetched as checkout_target, and bring any branch and submodules up to date
+def _checkout_repo(git_repo, path, reqd_commit, checkout_target, recurse_submodules, messages):
+    messages.append("Checking out required commit: %s" % reqd_commit)
+    _git(["git", "-C", path, "-c", "advice.detachedHead=false", "switch", "--detach", checkout_target], "git switch")
+    # a commit hash can't move, so there is nothing to pull
+    if not _is_commit_hash(reqd_commit):
+        messages.append("Ensuring any branch is on the head using git pull --ff-only origin %s" % reqd_commit)
+        _git(kGitRemoteCommand + ["-C", path, "pull", "--no-tags", "--ff-only", "origin", reqd_commit], "git merge")
+    if recurse_submodules:
+        # bring the submodules to the commits recorded by the new checkout
+        messages.append("Updating submodules of %s" % git_repo)
+        _git(kGitRemoteCommand + ["-C", path, "submodule", "update", "--init", "--recursive", "--jobs", str(kSubmoduleJobs)], "git submodule update")
+
+# Clone or update a single git repo, appending any messages to 'messages'.
+# Raises a RuntimeError if any git step fails.
+def _update_repo(git_repo, entry, update, messages):
+    path = _get_repo_path(entry)
+
+    # required commit
+    reqd_commit = entry[kCommitIndex]
+    # entries without a shallow clone field default to a shallow clone
+    shallow_clone = entry[kShallowCloneIndex] if len(entry) > kShallowCloneIndex else True
+    # entries without a recurse submodules field don't recurse into submodules
+    recurse_submodules = entry[kRecurseSubmodulesIndex] if len(entry) > kRecurseSubmodulesIndex else False
+
+    clone_submodule_args = ["--recurse-submodules", "-j", str(kSubmoduleJobs)] if recurse_submodules else []
+    fetch_submodule_args = ["--recurse-submodules=on-demand"] if recurse_submodules else []
+
+    if not os.path.isdir(path):
+        # directory doesn't exist - clone from git
+        messages.append("Directory %s does not exist, using 'git clone' to get latest from %s" % (path, git_repo))
+        if (shallow_clone):
+            _git(kGitRemoteCommand + ["clone", "--depth", "1", "--single-branch", "--no-tags"] + clone_submodule_args + ["--branch", reqd_commit, git_repo ,path], "git clone")
+        else:
+            # 'git clone --branch' doesn't accept a commit hash, so do a blobless clone without a checkout
+            # and then fetch only the required commit
+            _git(kGitRemoteCommand + ["clone", "--filter=blob:none", "--no-checkout"] + clone_submodule_args + [git_repo ,path], "git clone")
+        try:
+            checkout_target = reqd_commit
+            if not shallow_clone:
+                _git(kGitRemoteCommand + ["-C", path, "fetch", "--no-tags", "--depth", "1"] + fetch_submodule_args + ["origin", reqd_commit], "git fetch")
+                checkout_target = "FETCH_HEAD"
+            _checkout_repo(git_repo, path, reqd_commit, checkout_target, recurse_submodules, messages)
+        except RuntimeError:
+            # don't leave an incomplete clone behind, otherwise later runs would treat it as an existing dependency
+            messages.append("Removing incomplete clone %s" % path)
+            shutil.rmtree(path, onerror=_remove_readonly)
+            raise
+    elif update == True and _is_up_to_date(path, reqd_commit):
+        # directory exists and is already at the required commit - nothing to fetch
+        messages.append("Git Dependency %s is up to date at %s" % (git_repo, reqd_commit))
+    elif update == True:
+        # directory exists and update requested - get the required commit from git
+        # only limit the fetch depth for repos that are already shallow, so a full clone stays a full clone
+        depth_args = ["--depth", "1"] if _is_shallow(path) else []
+        fetch_args = ["fetch", "--no-tags"] + depth_args
+        messages.append("Directory %s exists, using 'git %s origin %s' to get latest from %s" % (path, " ".join(fetch_args), reqd_commit, git_repo))
+        _git(kGitRemoteCommand + ["-C", path] + fetch_args + fetch_submodule_args + ["origin", reqd_commit], "git fetch")
+        if not _is_commit_hash(reqd_commit):
+            _record_fetched_tag(path, reqd_commit)
+        _checkout_repo(git_repo, path, reqd_commit, "FETCH_HEAD", recurse_submodules, messages)
+    else:
+        # Directory exists and update not requested
+        messages.append("Git Dependency %s found and not updated" % git_repo)
+
+# Clone or update a single git repo. Returns True on success.
+# Messages are buffered and printed together at the end so output from concurrent repos doesn't interleave.
+def _process_repo(git_repo, entry, update):
+    messages = []
+    try:
+        _update_repo(git_repo, entry, update, messages)
+        return True
+    except RuntimeError as e:
+        messages.append(str(e))
+        return False
+    finally:
+        log_print_all(messages)
+
+# Clone or update all git repos, processing up to 'jobs' repos concurrently.
+def update_git_dependencies(git_mapping, update, jobs=kDefaultJobs):
+    # the lock file is only needed when updating - otherwise existing repos are left alone anyway
+    lock = _load_lock() if update else {}
+
+    repos_to_process = {}
     for git_repo in git_mapping:
-        # add script directory to path
-        tmp_path = os.path.join(script_root, git_mapping[git_repo][kDestinationIndex])
-
-        # clean up path, collapsing any ../ and converting / to \ for Windows
-        path = os.path.normpath(tmp_path)
-
-        # required commit
-        reqd_commit = git_mapping[git_repo][kCommitIndex]
-        shallow_clone = git_mapping[git_repo][kShallowCloneIndex]
-
-        do_checkout = False
-        if not os.path.isdir(path):
-            # directory doesn't exist - clone from git
-            log_print("Directory %s does not exist, using 'git clone' to get latest from %s" % (path, git_repo))
-            if (shallow_clone):
-                p = subprocess.Popen((["git", "clone", "--depth", "1", "--branch", reqd_commit, git_repo ,path]), stderr=subprocess.STDOUT)
-            else:
-                p = subprocess.Popen((["git", "clone", git_repo ,path]), stderr=subprocess.STDOUT)
-            p.wait()
-            if(p.returncode == 0):
-                do_checkout = True
-            else:
-                log_print("git clone failed with return code: %d" % p.returncode)
-                return False
-        elif update == True:
-            # directory exists and update requested - get latest from git
-            log_print("Directory %s exists, using 'git fetch --tags -f' to get latest from %s" % (path, git_repo))
-            p = subprocess.Popen((["git", "fetch", "--tags", "-f"]), cwd=path, stderr=subprocess.STDOUT)
-            p.wait()
-            if(p.returncode == 0):
-                do_checkout = True
-            else:
-                log_print("git fetch failed with return code: %d" % p.returncode)
-                return False
+        if update and _is_locked(lock.get(git_repo), git_mapping[git_repo]):
+            log_print("Git Dependency %s unchanged since last update at %s" % (git_repo, git_mapping[git_repo][kCommitIndex]))
         else:
-            # Directory exists and update not requested
-            log_print("Git Dependency %s found and not updated" % git_repo)
-
-        if do_checkout == True:
-            log_print("Checking out required commit: %s" % reqd_commit)
-            p = subprocess.Popen((["git", "checkout", reqd_commit]), cwd=path, stderr=subprocess.STDOUT)
-            p.wait()
-            if(p.returncode != 0):
-                log_print("git checkout failed with return code: %d" % p.returncode)
-                return False
-            log_print("Ensuring any branch is on the head using git pull --ff-only origin %s" % reqd_commit)
-            p = subprocess.Popen((["git", "pull", "--ff-only", "origin", reqd_commit]), cwd=path, stderr=subprocess.STDOUT)
-            p.wait()
-            if(p.returncode != 0):
-                log_print("git merge failed with return code: %d" % p.returncode)
+            repos_to_process[git_repo] = git_mapping[git_repo]
+
+    if len(repos_to_process) == 0:
+        return True
+
+    # Each repo spends most of its time waiting on the network, so use threads rather than processes.
+    max_workers = max(1, min(jobs, len(repos_to_process)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_process_repo, git_repo, repos_to_process[git_repo], update) for git_repo in repos_to_process]
+        for future in concurrent.futures.as_completed(futures):
+            if not future.result():
+                # fail fast - don't start any repos that are still waiting for a worker
+                for pending in futures:
+                    pending.cancel()
                 return False
 
+    if update:
+        for git_repo in repos_to_process:
+            lock_entry = _create_lock_entry(repos_to_process[git_repo])
+            if lock_entry is None:
+                lock.pop(git_repo, None)
+            else:
+                lock[git_repo] = lock_entry
+        _save_lock(lock)
+
     return True
 
 # Main body of update functionality
-def do_fetch_dependencies(update):
+def do_fetch_dependencies(update, jobs=kDefaultJobs):
     # Print git version being used
-    git_cmd = ["git", "--version"]
-    git_output = subprocess.check_output(git_cmd, stderr=subprocess.STDOUT)
-    log_print("%s" % git_output)
+    log_print("%s" % get_git_version())
+
+    # Check the git version once up front, rather than having every dependency fail on an unsupported command
+    git_version = _parse_git_version(get_git_version())
+    if git_version is not None and git_version < kMinGitVersion:
+        log_print("git %d.%d or later is required to fetch dependencies" % kMinGitVersion)
+        return False
 
     # Update all git dependencies
-    if update_git_dependencies(git_mapping, update):
+    if update_git_dependencies(git_mapping, update, jobs):
         return True
     else:
         return False
@@ -124,6 +362,7 @@ if __name__ == '__main__':
 
     # parse the command line arguments
     parser = argparse.ArgumentParser(description="A script that fetches all the necessary build dependencies for the project")
+    parser.add_argument("--jobs", type=int, default=kDefaultJobs, help="number of git repos to clone or update concurrently (default = %d)" % kDefaultJobs)
     args = parser.parse_args()
 
-    do_fetch_dependencies(True)
+    do_fetch_dependencies(True, args.jobs)
@@ -13,12 +13,16 @@
 import os
 import sys
 import stat
+import hashlib
 import importlib.util
 import argparse
 import shutil
 import subprocess
-import platform
 import time
+import threading
+import concurrent.futures
+from pathlib import Path
+from dataclasses import dataclass
 
 # Remember the start time
 start_time = time.time()
@@ -42,26 +46,67 @@ script_root = os.path.dirname(os.path.realpath(__file__))
 # also store the basename of the file
 script_name = os.path.basename(__file__)
 
-if sys.platform == "win32":
-    output_root = os.path.join(script_root, "win")
-elif sys.platform == "darwin":
-    output_root = os.path.join(script_root, "mac")
+# Settings that differ between the supported platforms
+@dataclass(frozen=True)
+class PlatformSpec:
+    # subdirectory of the script directory used as the default output location
+    output_subdir: str
+    # default root directory for locating Qt
+    default_qt_root: str
+    # platform specific portion of the Qt path name, formatted with the command line arguments
+    qt_leaf: str
+    # generate a Visual Studio solution containing both the Debug and Release configurations
+    supports_vs: bool = False
+    # allow Xcode to be used as the CMake generator
+    supports_xcode: bool = False
+    # allow the application to be built as a standard executable instead of an app bundle
+    supports_app_bundle: bool = False
+    # allow the system-installed version of Qt to be used
+    supports_qt_system: bool = False
+    # the dxc binary needs its execute permission set
+    chmod_dxc: bool = False
+
+platform_specs = {
+    "win32":  PlatformSpec(output_subdir="win",   default_qt_root="C:\\Qt", qt_leaf="msvc{qt_libver}_64", supports_vs=True),
+    "darwin": PlatformSpec(output_subdir="mac",   default_qt_root="~/Qt",   qt_leaf="clang_64", supports_xcode=True, supports_app_bundle=True),
+    "linux":  PlatformSpec(output_subdir="linux", default_qt_root="~/Qt",   qt_leaf="gcc_64", supports_qt_system=True, chmod_dxc=True),
+}
+
+# Look up the settings for this platform once. Anything unrecognized is treated like Linux
+host = platform_specs.get(sys.platform, platform_specs["linux"])
+
+output_root = os.path.join(script_root, host.output_subdir)
+
+# default to one build job per CPU available to this process
+if hasattr(os, "sched_getaffinity"):
+    default_build_jobs = len(os.sched_getaffinity(0))
 else:
-    output_root = os.path.join(script_root, "linux")
+    default_build_jobs = os.cpu_count() or 4
+
+# CMake generators selectable with --generator on platforms that don't use Visual Studio
+cmake_generators = {"ninja": "Ninja", "make": "Unix Makefiles"}
+if host.supports_xcode:
+    cmake_generators["xcode"] = "Xcode"
+
+# prefer Ninja when it's installed, as it configures and rebuilds faster than make
+ninja_exe = shutil.which("ninja")
+default_generator = "ninja" if ninja_exe else "make"
 
 # parse the command line arguments
 parser = argparse.ArgumentParser(description="A script that generates all the necessary build dependencies for a project")
-if sys.platform == "win32":
+if host.supports_vs:
     parser.add_argument("--vs", default="2022", choices=["2017", "2019", "2022"], help="specify the version of Visual Studio to be used with this script (default: 2022)")
     parser.add_argument("--toolchain", default="2022", choices=["2017", "2019", "2022"], help="specify the compiler toolchain to be used with this script (default: 2022)")
-    parser.add_argument("--qt-root", default="C:\\Qt", help="specify the root directory for locating QT on this system (default: C:\\Qt\\)")
-    parser.add_argument("--qt-libver", default="2019", choices=["2017", "2019"], help="specify the Qt lib version to be used with this script (default: 2019)")
-elif sys.platform == "darwin":
-    parser.add_argument("--xcode", action="store_true", help="specify Xcode should be used as generator for CMake")
-    parser.add_argument("--no-bundle", action="store_true", help="specify macOS application should be built as standard executable instead of app bundle")
-    parser.add_argument("--qt-root", default="~/Qt", help="specify the root directory for locating QT on this system (default: ~/Qt) ")
 else:
-    parser.add_argument("--qt-root", default="~/Qt", help="specify the root directory for locating QT on this system (default: ~/Qt) ")
+    parser.add_argument("--generator", choices=list(cmake_generators), help="specify the generator to be used with CMake (default: the generator of any existing build files, otherwise " + default_generator + ")")
+if host.supports_xcode:
+    parser.add_argument("--xcode", action="store_true", help="specify Xcode should be used as generator for CMake (same as --generator xcode)")
+if host.supports_app_bundle:
+    parser.add_argument("--no-bundle", action="store_true", help="specify macOS application should be built as standard executable instead of app bundle")
+parser.add_argument("--qt-root", default=host.default_qt_root, help="specify the root directory for locating QT on this system (default: " + host.default_qt_root + ")")
+if host.supports_vs:
+    parser.add_argument("--qt-libver", default="2019", choices=["2017", "2019"], help="specify the Qt lib version to be used with this script (default: 2019)")
+if host.supports_qt_system:
     parser.add_argument("--qt-system", action="store_true", help="use the system-installed version of QT")
 parser.add_argument("--qt", default="6.7.0", help="specify the version of QT to be used with the script (default: 6.7.0)" )
 parser.add_argument("--clean", action="store_true", help="delete any directories created by this script")
@@ -70,7 +115,7 @@ parser.add_argument("--build-number", default="0", help="specify the build numbe
 parser.add_argument("--update", action="store_true", help="Force fetch_dependencies script to update all dependencies")
 parser.add_argument("--output", default=output_root, help="specify the output location for generated cmake and build output files (default = OS specific subdirectory of location of pre_build.py script)")
 parser.add_argument("--build", action="store_true", help="build all supported configurations on completion of prebuild step")
-parser.add_argument("--build-jobs", default="4", help="number of simultaneous jobs to run during a build (default = 4)")
+parser.add_argument("--build-jobs", type=int, default=default_build_jobs, help="number of simultaneous jobs to run during a build (default = number of available CPUs)")
 parser.add_argument("--analyze", action="store_true", help="perform static analysis of code on build (currently VS2017 only)")
 parser.add_argument("--vscode", action="store_true", help="generate CMake options into VsCode settings file for this project")
 if support_32_bit_build:
@@ -84,41 +129,79 @@ config_suffix = ""
 
 ## Define some simple utility functions used lower down in the script
 
+# Lock used to serialize console output from worker threads
+log_lock = threading.Lock()
+
 # Print a message to the console with appropriate pre-amble
 def log_print(message):
-    print ("\n" + script_name + ": " + message)
+    with log_lock:
+        sys.stdout.write(f"\n{script_name}: {message}\n")
 
-# Print an error message to the console with appropriate pre-amble then exit
+# Print an error message to stderr with appropriate pre-amble then exit
+# stdout is flushed first so the error appears after any messages already printed
+# When called from a worker thread, the SystemExit is re-raised in the main thread when the worker's result is collected
 def log_error_and_exit(message):
-    print ("\nERROR: " + script_name + ": " + message)
-    sys.stdout.flush()
+    with log_lock:
+        sys.stdout.flush()
+        sys.stderr.write(f"\nERROR: {script_name}: {message}\n")
+        sys.stderr.flush()
     sys.exit(-1)
 
 # Remove a directory and all subdirectories - printing relevant status
 def rmdir_print(dir):
     log_print ("Removing directory - " + dir)
-    if os.path.exists(dir):
-        try:
-            shutil.rmtree(dir)
-        except Exception as e:
-            log_error_and_exit ("Failed to delete directory - " + dir + ": " + str(e))
-    else:
+    try:
+        shutil.rmtree(dir)
+    except FileNotFoundError:
         log_print ("    " + dir + " doesn't exist!")
+    except OSError as e:
+        log_error_and_exit ("Failed to delete directory - " + dir + ": " + str(e))
+
+# Run a single command to completion with its output going straight to the console. Returns the exit code.
+# The output isn't piped, so the command inherits the console.
+# Without a cwd, leaving fds open means subprocess can launch it with posix_spawn rather than fork and exec.
+def run_process(cmd, cwd=None):
+    with log_lock:
+        sys.stdout.flush()
+    return subprocess.run(cmd, cwd=cwd, close_fds=False).returncode
 
 # Make a directory if it doesn't exist - print information
 def mkdir_print(dir):
-    if not os.path.exists(dir):
-        log_print ("Creating Directory: " + dir)
+    try:
         os.makedirs(dir)
+        log_print ("Creating Directory: " + dir)
+    except FileExistsError:
+        pass
+
+# Get the sha256 of the dependency map, used to tell whether the dependencies need fetching again
+def get_deps_hash():
+    with open(os.path.join(script_root, "dependency_map.py"), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# Read the dependency map hash recorded by the last successful fetch. Returns None if there isn't one
+def read_deps_stamp(stamp_file):
+    try:
+        with open(stamp_file) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+# Record the dependency map hash after a successful fetch. The stamp is written to a temporary file
+# which then replaces the original, so an interrupted write can't leave a partial stamp behind
+def write_deps_stamp(stamp_file, deps_hash):
+    tmp_stamp_file = stamp_file + ".tmp"
+    with open(tmp_stamp_file, "w") as f:
+        f.write(deps_hash + "\n")
+    os.replace(tmp_stamp_file, stamp_file)
 
 # Generate the full path to QT, converting path to OS specific form
 # Look for Qt path in specified Qt root directory
 # Example:
 # --qt-root=C:\\Qt
 # --qt=6.7.0
-# Look first for C:\\Qt\\Qt6.7.0\\6.7.0
+# Look first for C:\\Qt\\Qt6.7.0\\6.7.0\\<leaf>
 #  (if not found..)
-# Look next for C:\\Qt\\6.7.0
+# Look next for C:\\Qt\\6.7.0\\<leaf>
 #
 # If neither of those can be found AND we are using the default
 # qt-root dir (i.e. the user did not specify --qt-root), then also
@@ -126,41 +209,39 @@ def mkdir_print(dir):
 # again. This allows the default Qt install path on Linux to be
 # found without needing to specify a qt-root
 #
+# The platform specific leaf directory is part of each candidate, so each location costs a single check
+#
 # Returns a tuple, containing a boolean and a string.
 # If the boolean is True, then the string is the found path to Qt.
 # If the boolean is False, then the string is an error message indicating which paths were searched
-def check_qt_path(qt_root, qt_root_arg, qt_arg):
+def check_qt_path(qt_root_arg, qt_arg, qt_leaf):
+    qt_root = Path(qt_root_arg).expanduser()
+    candidates = [qt_root / ("Qt" + qt_arg) / qt_arg / qt_leaf, qt_root / qt_arg / qt_leaf]
+    # if there is no user-specified qt-root, then check additional locations
+    # used by the various Qt installers
+    if qt_root_arg == parser.get_default('qt_root'):
+        candidates += [qt_root.parent / ("Qt" + qt_arg) / qt_arg / qt_leaf, qt_root.parent / qt_arg / qt_leaf]
+    qt_path = next((candidate for candidate in candidates if candidate.is_dir()), None)
+    if qt_path is not None:
+        return True, str(qt_path)
     qt_path_not_found_error = "Unable to find Qt root dir. Use --qt-root to specify\n    Locations checked:"
-    qt_path = os.path.normpath(qt_root + "/" + "Qt" + qt_arg + "/" + qt_arg)
-    if not os.path.exists(qt_path):
-        qt_path_not_found_error = qt_path_not_found_error + "\n      " + qt_path
-        qt_path = os.path.normpath(qt_root + "/" + qt_arg)
-        if not os.path.exists(qt_path):
-            qt_path_not_found_error = qt_path_not_found_error + "\n      " + qt_path
-            # if there is no user-specified qt-root, then check additional locations
-            # used by the various Qt installers
-            if qt_root_arg == parser.get_default('qt_root'):
-                qt_path = os.path.normpath(qt_root + "/../" + "Qt" + qt_arg + "/" + qt_arg)
-                if not os.path.exists(qt_path):
-                    qt_path_not_found_error = qt_path_not_found_error + "\n      " + qt_path
-                    qt_path = os.path.normpath(qt_root + "/../" + qt_arg)
-                    if not os.path.exists(qt_path):
-                        qt_path_not_found_error = qt_path_not_found_error + "\n      " + qt_path
-                        return False, qt_path_not_found_error
-            else:
-                return False, qt_path_not_found_error
-    return True, qt_path
+    for candidate in candidates:
+        qt_path_not_found_error = qt_path_not_found_error + "\n      " + str(candidate)
+    return False, qt_path_not_found_error
 
 if args.analyze and not args.build:
     log_error_and_exit("--analyze option requires the --build option to also be specified")
 
+if args.build_jobs < 1:
+    log_error_and_exit("--build-jobs must be at least 1")
+
 # check that the default output directory exists
 mkdir_print(args.output)
 
 # Define the output directory for CMake generated files
 cmake_output_dir = None
 
-if sys.platform == "win32":
+if host.supports_vs:
     cmake_output_dir = os.path.join(args.output, "vs" + args.toolchain)
 else:
     cmake_output_dir = os.path.join(args.output, "make")
@@ -173,19 +254,25 @@ if support_32_bit_build:
 # Clean all files generated by this script or the build process
 if (args.clean):
     log_print ("Cleaning build ...\n")
-    # delete the CMake output directory
-    rmdir_print(cmake_output_dir)
-    # delete the build output directories
-    for config in configs:
-        dir = os.path.join(args.output, config)
-        rmdir_print(dir)
+    # delete the CMake output directory and the build output directories. These are independent
+    # trees so remove them at the same time
+    clean_dirs = [cmake_output_dir] + [os.path.join(args.output, config) for config in configs]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(clean_dirs)) as executor:
+        list(executor.map(rmdir_print, clean_dirs))
     sys.exit(0)
 
 # Call fetch_dependencies script
 if can_fetch:
-    log_print ("Fetching project dependencies ...\n")
-    if (fetch_dependencies.do_fetch_dependencies(args.update) == False):
-        log_error_and_exit("Unable to retrieve dependencies")
+    # skip the fetch if the dependency map hasn't changed since the last successful fetch
+    deps_stamp_file = os.path.join(args.output, ".deps.stamp")
+    deps_hash = get_deps_hash()
+    if not args.update and read_deps_stamp(deps_stamp_file) == deps_hash and fetch_dependencies.dependencies_exist():
+        log_print ("Dependencies up to date, skipping fetch\n")
+    else:
+        log_print ("Fetching project dependencies ...\n")
+        if (fetch_dependencies.do_fetch_dependencies(args.update) == False):
+            log_error_and_exit("Unable to retrieve dependencies")
+        write_deps_stamp(deps_stamp_file, deps_hash)
 
 # Create the CMake output directory
 mkdir_print(cmake_output_dir)
@@ -193,27 +280,29 @@ mkdir_print(cmake_output_dir)
 if not args.no_qt:
     # locate the relevant QT libraries
     # generate the platform specific portion of the QT path name
-    if sys.platform == "win32":
-        qt_leaf = "msvc" + args.qt_libver + "_64"
-    elif sys.platform == "darwin":
-        qt_leaf = "clang_64"
-    else:
-        qt_leaf = "gcc_64"
+    qt_leaf = host.qt_leaf.format(**vars(args))
 
-    qt_expanded_root = os.path.expanduser(args.qt_root)
-    qt_found,qt_path = check_qt_path(qt_expanded_root, args.qt_root, args.qt)
+    qt_found,qt_path = check_qt_path(args.qt_root, args.qt, qt_leaf)
 
     if qt_found == False:
         log_error_and_exit(qt_path)
 
-    qt_path = os.path.normpath(qt_path + "/"  + qt_leaf)
-
-    if not os.path.exists(qt_path) and not args.no_qt:
-        log_error_and_exit ("QT Path does not exist - " + qt_path)
+# Read the generator used by any existing build files. Returns None if there are none
+def get_cached_generator():
+    for config in configs:
+        cache_file = os.path.join(cmake_output_dir, config + config_suffix, "CMakeCache.txt")
+        try:
+            with open(cache_file) as f:
+                for line in f:
+                    if line.startswith("CMAKE_GENERATOR:"):
+                        return line.split("=", 1)[1].strip()
+        except OSError:
+            pass
+    return None
 
 # Specify the type of Build files to generate
 cmake_generator = None
-if sys.platform == "win32":
+if host.supports_vs:
     if args.vs == "2022":
         cmake_generator="Visual Studio 17 2022"
     elif args.vs == "2019":
@@ -223,172 +312,192 @@ if sys.platform == "win32":
         if not support_32_bit_build or args.platform != "x86":
             cmake_generator = cmake_generator + " Win64"
 
-elif sys.platform == "darwin":
-    if args.xcode:
+else:
+    cached_generator = get_cached_generator()
+    if host.supports_xcode and args.xcode:
         cmake_generator="Xcode"
+    elif args.generator is not None:
+        cmake_generator=cmake_generators[args.generator]
+    elif cached_generator is not None:
+        # keep using the generator of the existing build files
+        cmake_generator=cached_generator
     else:
-        cmake_generator="Unix Makefiles"
-else:
-    cmake_generator="Unix Makefiles"
+        cmake_generator=cmake_generators[default_generator]
 
-# Common code related to generating a build configuration
-def generate_config(config):
-    if (config != ""):
-        cmake_dir = os.path.join(cmake_output_dir, config + config_suffix)
-        mkdir_print(cmake_dir)
-    else:
-        cmake_dir = cmake_output_dir
+    # CMake can't switch the generator of existing build files
+    if cached_generator is not None and cached_generator != cmake_generator:
+        log_error_and_exit("Build files in " + cmake_output_dir + " were generated with " + cached_generator + ", not " + cmake_generator + " - use --clean to remove them first")
 
-    cmakelist_path = os.path.join(script_root, os.path.normpath(".."))
+# Paths passed to CMake that are the same for every configuration
+cmakelist_path = os.path.join(script_root, os.path.normpath(".."))
+release_output_dir = os.path.join(args.output, "release" + config_suffix)
+debug_output_dir = os.path.join(args.output, "debug" + config_suffix)
 
-    release_output_dir = os.path.join(args.output, "release" + config_suffix)
-    debug_output_dir = os.path.join(args.output, "debug" + config_suffix)
+# Get the CMake build directory for a configuration
+def get_cmake_dir(config):
+    if (config != ""):
+        return os.path.join(cmake_output_dir, config + config_suffix)
+    return cmake_output_dir
 
+# Common code related to generating a build configuration
+# Returns the arguments used to run CMake for the configuration, along with the -D definitions and generator
+# name needed by VSCode. These are collected as the arguments are built, rather than scanned for afterwards
+def get_cmake_args(config):
     if args.no_qt:
-        cmake_args = ["cmake", cmakelist_path, "-DHEADLESS=TRUE"]
+        qt_dargs = ["-DHEADLESS=TRUE"]
     else:
-        cmake_args = ["cmake", cmakelist_path, "-DCMAKE_PREFIX_PATH=" + qt_path, "-G", cmake_generator]
+        qt_dargs = ["-DCMAKE_PREFIX_PATH=" + qt_path]
+    generator_name = cmake_generator
+    generator_args = ["-G", generator_name]
 
-    if sys.platform == "win32":
+    vs_args = []
+    if host.supports_vs:
         if args.vs != "2017":
             if not support_32_bit_build or args.platform != "x86":
-                cmake_args.extend(["-A" + "x64"])
+                vs_args.append("-A" + "x64")
 
             if args.toolchain == "2019":
-                cmake_args.extend(["-Tv142"])
+                vs_args.append("-Tv142")
             elif args.toolchain == "2017":
-                cmake_args.extend(["-Tv141"])
+                vs_args.append("-Tv141")
 
-    if sys.platform.startswith('linux'):
-        if args.qt_system:
-            cmake_args.extend(["-DQT_SYSTEM:BOOL=TRUE"])
+    qt_system_dargs = ["-DQT_SYSTEM:BOOL=TRUE"] if host.supports_qt_system and args.qt_system else []
+    bundle_dargs = ["-DNO_APP_BUNDLE=" + str(args.no_bundle)] if host.supports_app_bundle else []
 
+    if host.chmod_dxc:
         # Add execute file permission to dxc
         dxc_file = os.path.join(script_root, "../external/third_party/dxc/bin/dxc")
         if os.path.exists(dxc_file):
             os.chmod(dxc_file, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
 
-    cmake_args.extend(["-DRRA_BUILD_NUMBER=" + str(args.build_number)])
-    cmake_args.extend(["-DQT_VERSION=" + str(args.qt)])
-
-    cmake_args.extend(["-DCMAKE_RUNTIME_OUTPUT_DIRECTORY_RELEASE=" + release_output_dir])
-    cmake_args.extend(["-DCMAKE_LIBRARY_OUTPUT_DIRECTORY_RELEASE=" + release_output_dir])
-    cmake_args.extend(["-DCMAKE_RUNTIME_OUTPUT_DIRECTORY_DEBUG=" + debug_output_dir])
-    cmake_args.extend(["-DCMAKE_LIBRARY_OUTPUT_DIRECTORY_DEBUG=" + debug_output_dir])
-
-    if sys.platform != "win32":
+    # -DCMAKE_BUILD_TYPE is not passed on to VSCode as it's not relevant for VSCode builds
+    build_type_args = []
+    if not host.supports_vs:
         if "RELEASE" in config.upper():
-            cmake_args.extend(["-DCMAKE_BUILD_TYPE=Release"])
+            build_type_args = ["-DCMAKE_BUILD_TYPE=Release"]
         elif "DEBUG" in config.upper():
-            cmake_args.extend(["-DCMAKE_BUILD_TYPE=Debug"])
+            build_type_args = ["-DCMAKE_BUILD_TYPE=Debug"]
         else:
             log_error_and_exit("unknown configuration: " + config)
 
-    if sys.platform == "darwin":
-        cmake_args.extend(["-DNO_APP_BUNDLE=" + str(args.no_bundle)])
-
-
-    if args.vscode:
-        # Generate data into VSCode Settings file
-
-        # only generate this file once - even though parent function is called twice on linux platforms
-        if (config == "") or (config == "debug"):
-            import json
-
-            vscode_json_path = cmakelist_path + "/.vscode"
-            vscode_json_file = vscode_json_path + "/settings.json"
-
-            log_print ("Updating VSCode settings file: " + vscode_json_file)
-
-            if os.path.isfile(vscode_json_file):
-                # if file exists load the contents as a JSON data blob
-                with open(vscode_json_file) as f:
-                    json_data = json.load(f)
-            else:
-                # file doesn't exist
-                if not os.path.isdir(vscode_json_path):
-                    # .vscode directory doesn't exist - create it
-                    os.mkdir(vscode_json_path)
-                # initialize dictionary with no data
-                json_data = {}
-
-            cmake_configure_args = []
-            for index, arg in enumerate(cmake_args):
-                # only include cmake arguments starting with -D.
-                # Ignore -DCMAKE_BUILD_TYPE as it's not relevant for VSCode builds
-                if not arg.startswith("-DCMAKE_BUILD_TYPE") and arg.startswith("-D"):
-                    cmake_configure_args.append(arg)
-                if arg.startswith("-G"):
-                    # next argument is the generator type to be captured
-                    json_data['cmake.generator'] = cmake_args[index + 1]
-            json_data['cmake.configureArgs'] = cmake_configure_args
-
-            # define the build directory used by cmake
-            cmake_build_directory = cmake_dir
-            if (config == "debug"):
-                # On linux - use the build type from vscode to define the config
-                cmake_build_directory = cmake_build_directory.replace("debug", "${buildType}", 1)
-            json_data['cmake.buildDirectory'] = cmake_build_directory
-
-            with open(vscode_json_file, 'w') as f:
-                json.dump(json_data, f, indent=4)
-
-    if not shutil.which(cmake_args[0]):
-        log_error_and_exit("cmake not found")
-
-    p = subprocess.Popen(cmake_args, cwd=cmake_dir, stderr=subprocess.STDOUT)
-    p.wait()
-    sys.stdout.flush()
-    if(p.returncode != 0):
-        log_error_and_exit("cmake failed with %d" % p.returncode)
+    # the -D definitions passed on to VSCode
+    cmake_dargs = [*qt_dargs,
+                   *qt_system_dargs,
+                   "-DRRA_BUILD_NUMBER=" + str(args.build_number),
+                   "-DQT_VERSION=" + str(args.qt),
+                   "-DCMAKE_RUNTIME_OUTPUT_DIRECTORY_RELEASE=" + release_output_dir,
+                   "-DCMAKE_LIBRARY_OUTPUT_DIRECTORY_RELEASE=" + release_output_dir,
+                   "-DCMAKE_RUNTIME_OUTPUT_DIRECTORY_DEBUG=" + debug_output_dir,
+                   "-DCMAKE_LIBRARY_OUTPUT_DIRECTORY_DEBUG=" + debug_output_dir,
+                   *bundle_dargs]
+
+    cmake_args = [cmake_exe, cmakelist_path, *generator_args, *vs_args, *cmake_dargs, *build_type_args]
+
+    return cmake_args, cmake_dargs, generator_name
+
+# Run CMake for a configuration and return its exit code
+# CMake generates build files into its working directory, as the -B option needs CMake 3.13
+def generate_config(config, cmake_args):
+    cmake_dir = get_cmake_dir(config)
+    mkdir_print(cmake_dir)
+    return run_process(cmake_args, cmake_dir)
+
+# Generate data into the VSCode settings file. The CMake arguments given to VSCode are the same for every
+# configuration, so this only needs doing once using the arguments of any configuration
+def update_vscode_settings(cmake_dargs, generator_name):
+    import json
+
+    vscode_json_path = cmakelist_path + "/.vscode"
+    vscode_json_file = vscode_json_path + "/settings.json"
+
+    log_print ("Updating VSCode settings file: " + vscode_json_file)
+
+    if os.path.isfile(vscode_json_file):
+        # if file exists load the contents as a JSON data blob
+        with open(vscode_json_file) as f:
+            json_data = json.load(f)
+    else:
+        # file doesn't exist
+        if not os.path.isdir(vscode_json_path):
+            # .vscode directory doesn't exist - create it
+            os.mkdir(vscode_json_path)
+        # initialize dictionary with no data
+        json_data = {}
+
+    json_data['cmake.generator'] = generator_name
+    json_data['cmake.configureArgs'] = cmake_dargs
+
+    # define the build directory used by cmake
+    if host.supports_vs:
+        json_data['cmake.buildDirectory'] = cmake_output_dir
+    else:
+        # On linux - use the build type from vscode to define the config
+        json_data['cmake.buildDirectory'] = get_cmake_dir("${buildType}")
+
+    # write to a temporary file and then replace the original, so the settings file is never left partially written
+    vscode_json_tmp_file = vscode_json_file + ".tmp"
+    with open(vscode_json_tmp_file, 'w') as f:
+        json.dump(json_data, f, indent=4)
+    os.replace(vscode_json_tmp_file, vscode_json_file)
+
+# locate cmake once, rather than searching the PATH for every command
+cmake_exe = shutil.which("cmake")
+if not cmake_exe:
+    log_error_and_exit("cmake not found")
 
 log_print("Generating build files ...")
-if sys.platform == "win32":
+if host.supports_vs:
     # On Windows always generates both Debug and Release configurations in a single solution file
-    generate_config("")
+    generate_configs = [""]
 else:
-    # For Linux & Mac - generate both Release and Debug configurations
-    for config in configs:
-        generate_config(config)
+    # For Linux & Mac - generate both Release and Debug configurations. These are generated one after
+    # the other, as CMakeLists.txt uses configure_file to write files in the source tree that every
+    # configuration shares
+    generate_configs = configs
+
+cmake_args_list = [get_cmake_args(config) for config in generate_configs]
+
+if args.vscode:
+    _, cmake_dargs, generator_name = cmake_args_list[0]
+    update_vscode_settings(cmake_dargs, generator_name)
+
+for config, (cmake_args, _, _) in zip(generate_configs, cmake_args_list):
+    returncode = generate_config(config, cmake_args)
+    if(returncode != 0):
+        log_error_and_exit("cmake failed with %d" % returncode)
 
 # Optionally, the user can choose to build all configurations on conclusion of the prebuild job
 if (args.build):
+    # make sure any nested cmake --build invocations use the same level of parallelism
+    build_jobs = str(args.build_jobs)
+    os.environ["CMAKE_BUILD_PARALLEL_LEVEL"] = build_jobs
+
     for config in configs:
         log_print( "\nBuilding " + config + " configuration\n")
         build_dir = ""
 
-        cmake_args_docs = ""
-        if sys.platform == "win32":
+        # The Documentation target is part of ALL (see CMakeLists.txt), so it is built alongside the code
+        # by the same job pool rather than in a separate build step afterwards
+        if host.supports_vs:
             build_dir = cmake_output_dir
 
             # For Visual Studio, specify the config to build
-            cmake_args = ["cmake", "--build", build_dir, "--config", config, "--target", "ALL_BUILD", "--",  "/m:" + args.build_jobs]
+            # cmake passes --parallel on to MSBuild as /m:<jobs>
+            cmake_args = [cmake_exe, "--build", build_dir, "--config", config, "--target", "ALL_BUILD", "--parallel", build_jobs]
             if args.analyze:
+                cmake_args.append("--")
                 cmake_args.append("/p:CodeAnalysisRuleSet=NativeMinimumRules.ruleset")
                 cmake_args.append("/p:RunCodeAnalysis=true")
-
-            cmake_args_docs = ["cmake", "--build", build_dir, "--config", config, "--target", "Documentation", "--", "/m:" + args.build_jobs]
         else:
             # linux & mac use the same commands
             # generate the path to the config specific makefile
             build_dir = os.path.join(cmake_output_dir, config + config_suffix)
 
-            cmake_args = ["cmake", "--build", build_dir, "--parallel", args.build_jobs]
-
-            cmake_args_docs = ["cmake", "--build", build_dir, "--config", config, "--target", "Documentation", "--parallel", args.build_jobs]
+            cmake_args = [cmake_exe, "--build", build_dir, "--parallel", build_jobs]
 
-        p = subprocess.Popen(cmake_args, cwd=cmake_output_dir, stderr=subprocess.STDOUT)
-        p.wait()
-        sys.stdout.flush()
-
-        if(p.returncode != 0):
-            log_error_and_exit("CMake build failed with %d" % p.returncode)
-
-        log_print( "\nBuilding Documentation\n")
-
-        p = subprocess.Popen(cmake_args_docs, cwd=cmake_output_dir, stderr=subprocess.STDOUT)
-        p.wait()
-        sys.stdout.flush()
+        returncode = run_process(cmake_args)
+        if(returncode != 0):
+            log_error_and_exit("CMake build failed with %d" % returncode)
 
 minutes, seconds = divmod(time.time() - start_time, 60)
 log_print("Successfully completed in {0:.0f} minutes, {1:.1f} seconds".format(minutes,seconds))